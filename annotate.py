@@ -8,18 +8,21 @@ import re
 import fnmatch
 import urllib
 import json
+import zlib
+import hashlib
 
 if sys.version_info >= (3, 0):
   import urllib
 
   from urllib.parse import urlencode
   from urllib.request import Request, urlopen
+  from urllib.error import HTTPError
 
 
 else:
   from urllib import urlencode
   import urllib2
-  from urllib2 import Request, urlopen
+  from urllib2 import Request, urlopen, HTTPError
 
 
 env = os.environ
@@ -36,6 +39,9 @@ class bcolors:
 
 parser = argparse.ArgumentParser()
 
+parser.add_argument("--dedup", help="Only send a reference if the server has the log already, e.g. from another job of a build matrix.", action='store_true', default=False)
+parser.add_argument("--blob_index", help="The file to record the uploaded logs in, if the server takes references but can't tell which it has. Default is next to the id file, point it to a shared cache to dedup across jobs.")
+parser.add_argument("--no_compression", help="Send the log uncompressed, instead of trying gzip first.", action='store_true', default=False)
 parser.add_argument("-t", "--token", help="Token to authenticate (not needed for public projects on appveyor, travis and circle-ci")
 parser.add_argument("-n", "--name", help="Custom defined name of the upload when commiting several builds with the same ci system")
 parser.add_argument("-o", "--tool", choices=["gcc", "go", "java", "msvc", "net", "node", "php", "python", "ruby" ],
@@ -84,6 +90,12 @@ if not args.check_run:
   except:
     pass
 
+started_at = None
+try:
+  started_at = json.loads(open(args.id_file, "r").read())["started-at"]
+except:
+  pass
+
 ## Alright, now detect the CI - thanks to codecov for the content
 
 root_dir = None
@@ -463,21 +475,89 @@ if sys.version_info >= (3, 0):
 if args.check_run and not args.name and 'run-name' in query:
   del query['run-name']
 
-request = Request(url + "?" + urlencode(query), upload_content , headers)
-if args.token:   request.add_header("Authorization",  "Bearer " + args.token)
+## with --dedup, a log the server has already is only referenced by its hash, e.g. the same lint log from all jobs of a matrix.
+## If the server can't tell which it has, but says it takes references, the logs uploaded from here before stand in.
+blobs_url = "https://api.report.ci/blobs/"
+blob_index_file = args.blob_index or os.path.join(os.path.dirname(args.id_file), ".report-ci-blobs.json")
+blob_index_size = 100000
 
-request.add_header("Content-Type", "text/plain")
+def read_blob_index():
+  try:
+    return json.loads(open(blob_index_file, "r").read())
+  except:
+    return {}
 
-if args.check_run:
-  request.get_method = lambda: 'PATCH'
+def known_blobs(hashes):
+  request = Request(blobs_url + "?" + urlencode({'owner': owner, 'repo': repo}), json.dumps({'hashes': hashes}).encode('utf-8'), {})
+  request.add_header("Content-Type", "application/json")
+  if args.token: request.add_header("Authorization",  "Bearer " + args.token)
+  try:
+    answer = json.loads(urlopen(request).read().decode())
+  except Exception:
+    print(bcolors.WARNING + "The server can't tell which logs it has, sending them all" + bcolors.ENDC)
+    return set()
+  if "known" in answer:
+    return set(answer["known"])
+  if answer.get("references"):
+    print(bcolors.OKBLUE + "The server takes references but can't tell which logs it has, using the local index " + blob_index_file + bcolors.ENDC)
+    return set(read_blob_index().get(owner + '/' + repo, []))
+  return set()
+
+def record_blobs(hashes):
+  index = read_blob_index()
+  blobs = [blob for blob in index.get(owner + '/' + repo, []) if blob not in hashes] + sorted(hashes)
+  index[owner + '/' + repo] = blobs[-blob_index_size:]
+  try:
+    open(blob_index_file, 'w').write(json.dumps(index))
+  except:
+    print(bcolors.WARNING + "Could not write the blob index " + blob_index_file + bcolors.ENDC)
+
+blob = None
+if args.dedup:
+  blob = "sha256:" + hashlib.sha256(upload_content).hexdigest()
+  if blob in known_blobs([blob]):
+    print(bcolors.OKBLUE + "    The log is known to the server already, only sending a reference" + bcolors.ENDC)
+    query['raw-data-ref'] = blob
+    upload_content = b''
+
+## the logs are very repetitive, gzip gets them down a lot
+def gzip_content(content):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+  return compressor.compress(content) + compressor.flush()
+
+def make_request(compressed):
+  request = Request(url + "?" + urlencode(query), gzip_content(upload_content) if compressed else upload_content, headers)
+  if args.token:   request.add_header("Authorization",  "Bearer " + args.token)
+  request.add_header("Content-Type", "text/plain")
+  if compressed:   request.add_header("Content-Encoding", "gzip")
+
+  if args.check_run:
+    request.get_method = lambda: 'PATCH'
+  return request
+
+# servers that don't take gzip get the plain body
+def send():
+  if args.no_compression:
+    return urlopen(make_request(False))
+  try:
+    return urlopen(make_request(True))
+  except HTTPError as e:
+    if e.code not in [400, 415]:
+      raise
+    print(bcolors.WARNING + "The compressed upload was rejected (" + str(e.code) + "), sending it uncompressed." + bcolors.ENDC)
+    return urlopen(make_request(False))
 
 try:
-  response = urlopen(request).read().decode()
+  response = send().read().decode()
   print(bcolors.OKGREEN + "Annotating: '{0}".format(response) + bcolors.ENDC)
   res = json.loads(response)
   ch_id = str(res["id"])
   print ('Uploaded log-file https://report.ci/reports/gh/{}/{}/rep/{}'.format(owner, repo, ch_id))
-  open(args.id_file, 'w').write(response)
+  if started_at is not None:
+    res["started-at"] = started_at
+  open(args.id_file, 'w').write(json.dumps(res))
+  if blob is not None:
+    record_blobs(set([blob]))
   exit(0)
 except Exception as e:
   print(bcolors.FAIL + 'Annotating failed: {0}'.format(e) + bcolors.ENDC)
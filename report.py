@@ -6,20 +6,48 @@ import argparse
 import subprocess
 import re
 import fnmatch
+import glob
+import gzip
+import bz2
+import zlib
+import zipfile
+import tarfile
+import io
 import urllib
 import json
+import collections
+import codecs
+import math
+import multiprocessing
+import mmap
+import hashlib
+import tempfile
+import shutil
+import atexit
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+try:
+  from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+except ImportError:
+  ThreadPoolExecutor = None
+  ProcessPoolExecutor = None
 
 if sys.version_info >= (3, 0):
   import urllib
 
   from urllib.parse import urlencode
   from urllib.request import Request, urlopen
+  from urllib.error import HTTPError
 
 
 else:
   from urllib import urlencode
   import urllib2
-  from urllib2 import Request, urlopen
+  from urllib2 import Request, urlopen, HTTPError
 
 
 env = os.environ
@@ -36,6 +64,9 @@ class bcolors:
 
 parser = argparse.ArgumentParser()
 
+## directories that never hold reports worth the walk
+prune_default = [".git*", ".hg", ".svn", "node_modules", "bower_components", ".gradle", ".m2", "bazel-out", ".tox", ".venv", "__pycache__"]
+
 ##
 tools = ["gcc", "go", "java", "msvc", "net",  "node", "php", "python", "ruby"]
 frameworks = ["boost", "junit", "testng", "xunit", "cmocka", "unity", "criterion", "bandit",
@@ -75,7 +106,27 @@ framework_names = {
   "doctest":   "Doctest"
 }
 
-parser.add_argument("-i", "--include", nargs='+', help="Test files to include with auto, can cointain unix-style wildcard. (default *.xml)", default=["*.xml", "*.json", "*.trx", "*.tap"])
+include_default = ["*.xml", "*.json", "*.trx", "*.tap"]
+
+## where the frameworks put their reports unless told otherwise, relative to the root dir
+known_report_dirs = {
+  "junit":    ["target/surefire-reports", "target/failsafe-reports", "*/target/surefire-reports", "*/target/failsafe-reports",
+               "build/test-results", "*/build/test-results"],
+  "testng":   ["test-output", "*/test-output"],
+  "xunit":    ["bazel-testlogs", "test-results", "test-reports", "reports", "junit*.xml"],
+  "gtest":    ["test_detail.xml", "build/test_detail.xml"],
+  "go-test":  ["test-results", "go-test*.json"],
+  "rspec":    ["rspec*.json", "tmp/rspec*.json"],
+  "mocha":    ["mochawesome-report", "test-results.json"],
+  "nunit":    ["TestResult.xml", "*/TestResult.xml"],
+  "mstest":   ["TestResults", "*/TestResults"],
+  "xunitnet": ["TestResults", "*/TestResults"],
+  "pytest":   ["junit*.xml", "test-reports", "reports"],
+  "phpunit":  ["build/logs", "build/reports"],
+  "tap":      ["*.tap"]
+}
+
+parser.add_argument("-i", "--include", nargs='+', help="Test files to include with auto, can cointain unix-style wildcard. (default *.xml)", default=include_default)
 
 
 for fr in frameworks:
@@ -89,9 +140,30 @@ for t in tools:
 parser.add_argument('-l-<tool>, --log-as-<tool>', nargs='+', help="Define logfiles files for <tools>, similar to --include. Available values for tool: [" + ', '.join(tools) + ']')
 
 
-parser.add_argument("-x", "--exclude",   nargs='+', help="Test files to exclude, can cointain unix-style wildcard.",      default=[])
+parser.add_argument("-x", "--exclude",   nargs='+', help="Test files to exclude, can cointain unix-style wildcard. Directories matching are not searched.", default=[])
+parser.add_argument("-P", "--prune",     nargs='*', help="Directory names not to descend into, can cointain unix-style wildcard. (default " + ' '.join(prune_default) + ")", default=prune_default)
+parser.add_argument("--follow-symlinks", help="Follow symlinked directories and files when searching, e.g. bazel-testlogs. Every file is only read once, no matter how many links lead to it.", action='store_true', default=False)
+parser.add_argument("-g", "--discovery", help="How to find the files: walk the root dir, read the git index, i.e. tracked and untracked but not ignored files, or look where the frameworks put their reports by default and walk only if there are none.", choices=["walk", "git", "known"], default="walk")
+parser.add_argument("--output-dir", nargs='+', help="Only look into these directories when using git discovery.", default=[])
+parser.add_argument("--allow-ignored", nargs='+', help="Ignored directories to search nonetheless when using git discovery, e.g. build output.", default=[])
+parser.add_argument("-A", "--archive", nargs='+', help="Zip or tar archives to search like directories, without extracting them. Can cointain unix-style wildcard, e.g. *.zip *.tar.gz", default=[])
+parser.add_argument("-S", "--since", nargs='?', const="job", help="Ignore files last modified before this time, in seconds since the epoch. Without a value, the start of the job as recorded in the id file by start.py or queue.py is used.")
+parser.add_argument("-R", "--scan-root", nargs='+', help="Further directories to search for reports, e.g. a build dir outside the root dir. They are searched in parallel.", default=[])
+parser.add_argument("-L", "--file-list-from", help="Read the explicit file list from this file, '-' for stdin. Paths are NUL or newline delimited, e.g. from find -print0.")
 parser.add_argument("-l", "--file-list", nargs='+', help="Explicit file list, if given include and exclude are ignored.", default=None)
 
+parser.add_argument("-j", "--jobs", type=int, help="Number of files to read in parallel. Default is derived from the available CPUs.")
+parser.add_argument("--processes", type=int, nargs='?', const=0, help="Detect the frameworks in this many processes, for very large numbers of reports. Without a number one per available CPU is used.")
+parser.add_argument("--cache-file", help="The file to cache the framework detection in, so repeated invocations only open changed files. Default is next to the id file.")
+parser.add_argument("--no-cache", help="Don't read or write the detection cache.", action='store_true', default=False)
+parser.add_argument("--delta", help="Only send the reports & logs that are new or changed since the last upload to the same check run. Only use this when the server keeps what was uploaded before, a PATCH overwrites it otherwise and the check run would end up with the changes only.", action='store_true', default=False)
+parser.add_argument("--dedup", help="Only send a reference for reports & logs the server has already, e.g. from another job of a build matrix.", action='store_true', default=False)
+parser.add_argument("--blob-index", help="The file to record the uploaded contents in, if the server takes references but can't tell which it has. Default is next to the id file, point it to a shared cache to dedup across jobs.")
+parser.add_argument("--compact-files", help="Send the file list relative to the root dir and front coded, which is a lot smaller for big trees.", action='store_true', default=False)
+parser.add_argument("--files-include", nargs='+', help="Only send these files in the file list used to resolve the paths in the reports, can cointain unix-style wildcard, e.g. *.java *.py")
+parser.add_argument("--state-file", help="The file to record the uploaded shards in, so a failed upload can be resumed by running the same step again. Default is next to the id file.")
+parser.add_argument("--shard", help="Split uploads over 10MB into several, the first one creates the check run and the rest gets patched into it one after another. Only use this when the server keeps what was uploaded before, a PATCH overwrites it otherwise.", action='store_true', default=False)
+parser.add_argument("--no-compression", help="Send the reports uncompressed, instead of trying gzip first.", action='store_true', default=False)
 parser.add_argument("-t", "--token", help="Token to authenticate (not needed for public projects on appveyor, travis and circle-ci")
 parser.add_argument("-n", "--name", help="Custom defined name of the upload when commiting several builds with the same ci system")
 
@@ -126,9 +198,16 @@ if not args.check_run:
   except:
     pass
 
+started_at = None
+try:
+  started_at = json.loads(open(args.id_file, "r").read())["started-at"]
+except:
+  pass
+
 ## Alright, now detect the CI - thanks to codecov for the content
 
 root_dir = None
+search_in = None
 service = None
 branch  = None
 commit  = None
@@ -501,201 +580,1135 @@ if not owner or not repo:
 print (bcolors.OKBLUE + "    Project: " + owner + '/' + repo + bcolors.ENDC)
 
 # find
-def match_file(file_abs, include):
-  match = False
-  file = os.path.relpath(file_abs)
-  for inc in include:
-    if fnmatch.fnmatch(file, inc) or fnmatch.fnmatch(file_abs, inc):
-      match = True
-      break
+# all pattern sets get compiled once, so a path is classified with a handful of regex matches
+def compile_patterns(patterns):
+  if not patterns:
+    return None
+  return re.compile('|'.join('(?:' + fnmatch.translate(os.path.normcase(pat)) + ')' for pat in patterns))
+
+cwd_prefix = os.path.join(os.getcwd(), '')
+
+def rel_path(file_abs):
+  if file_abs.startswith(cwd_prefix):
+    return file_abs[len(cwd_prefix):]
+  return os.path.relpath(file_abs)
+
+def match_patterns(pattern, file, file_abs):
+  return pattern is not None and (pattern.match(file) is not None or pattern.match(file_abs) is not None)
+
+incl_frameworks = []
+for arg in sys.argv:
+  for prefix in ['--include-as-', '-i-']:
+    if arg.startswith(prefix) and arg[len(prefix):].split('=')[0] in frameworks:
+      incl_frameworks.append(arg[len(prefix):].split('=')[0])
+incl_frameworks.reverse()
 
-  for exc in args.exclude:
-    if fnmatch.fnmatch(file, exc) or fnmatch.fnmatch(file_abs, exc):
-      match = False
-      break
+include_pattern = compile_patterns(args.include)
+exclude_pattern = compile_patterns(args.exclude)
 
-  return match
+pattern_sets = [('include', include_pattern)]
+all_patterns = list(args.include)
+for framework in incl_frameworks:
+  incl = getattr(args, 'include_as_' + framework.replace('-', '_'))
+  if incl:
+    pattern_sets.append((('framework', framework), compile_patterns(incl)))
+    all_patterns += incl
+
+for tool in tools:
+  incl = getattr(args, 'log_as_' + tool)
+  if incl:
+    pattern_sets.append((('tool', tool), compile_patterns(incl)))
+    all_patterns += incl
+
+any_pattern = compile_patterns(all_patterns)
+
+## compressed reports are read as they are, the patterns apply to the name without the compression suffix too
+compressions = {".gz": gzip.open, ".bz2": bz2.BZ2File}
+if lzma is not None:
+  compressions[".xz"] = lzma.open
+
+## what a broken or truncated compressed file or archive member can raise
+read_errors = (IOError, EOFError, zlib.error, zipfile.BadZipfile) + ((lzma.LZMAError,) if lzma is not None else ())
+
+def strip_compression(file):
+  (base, ext) = os.path.splitext(file)
+  return base if ext.lower() in compressions else None
+
+## reports found in archives, by their path inside the archive, e.g. artifacts.zip/node-1/TEST-foo.xml.
+## Zip members are read from their archive when needed, tar members get spilled into a temporary directory,
+## as a compressed tar can only be read front to back.
+archive_members = {}
+member_archives = {}
+spill_dirs = []
+
+def spill_member(data):
+  if not spill_dirs:
+    spill_dirs.append(tempfile.mkdtemp(prefix="report-ci-"))
+    atexit.register(shutil.rmtree, spill_dirs[0], True)
+  (fd, spill_file) = tempfile.mkstemp(dir=spill_dirs[0])
+  with os.fdopen(fd, "wb") as out:
+    shutil.copyfileobj(data, out)
+  return spill_file
+
+def open_member(abs_file):
+  (archive_abs, name) = archive_members[abs_file]
+  if archive_abs is None:
+    return open(name, "rb")
+  archive = zipfile.ZipFile(archive_abs)
+  try:
+    member = archive.open(name)
+    if not (hasattr(member, "seekable") and member.seekable()): # before 3.7 zip members can't seek, the sniffing needs that
+      try:
+        return io.BytesIO(member.read())
+      finally:
+        member.close()
+    return member # keeps the archive file open until it is closed itself
+  finally:
+    archive.close()
+
+def open_report(abs_file):
+  opener = compressions.get(os.path.splitext(abs_file)[1].lower())
+  if abs_file in archive_members:
+    source = open_member(abs_file)
+    return opener(source, "rb") if opener is not None else source
+  if opener is not None:
+    return opener(abs_file, "rb")
+  return open(abs_file, "rb")
+
+def report_ext(abs_file):
+  return os.path.splitext(strip_compression(abs_file) or abs_file)[1].lower()
+
+# yields the buckets (include, ('framework', fr), ('tool', tool)) a file belongs to
+def classify(file_abs):
+  names = [(os.path.normcase(rel_path(file_abs)), os.path.normcase(file_abs))]
+  if strip_compression(file_abs) is not None:
+    names.append((strip_compression(names[0][0]), strip_compression(names[0][1])))
+
+  def matches(pattern):
+    return any(match_patterns(pattern, file, file_abs) for (file, file_abs) in names)
+
+  if not matches(any_pattern) or matches(exclude_pattern):
+    return []
+  return [bucket for (bucket, pattern) in pattern_sets if matches(pattern)]
+
+def prune_dir(name, dir_abs):
+  for pr in args.prune:
+    if fnmatch.fnmatch(name, pr):
+      return True
+
+  return match_patterns(exclude_pattern, os.path.normcase(rel_path(dir_abs)), os.path.normcase(dir_abs))
+
+## following symlinks, every directory & file is only visited once by (device, inode), which also breaks cycles
+visited = set()
+
+def first_visit(key):
+  if key is None or key in visited:
+    return False
+  visited.add(key)
+  return True
+
+def inode_key(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_dev, st.st_ino)
+
+# walk the tree with scandir, so pruned directories are never entered and d_type spares us the stat calls
+def walk_files(top):
+  follow = args.follow_symlinks
+  if follow and not first_visit(inode_key(top)):
+    return
+
+  if not hasattr(os, 'scandir'):
+    for (path, subfolders, files) in os.walk(top, followlinks=follow):
+      subfolders[:] = [sub for sub in subfolders if not prune_dir(sub, os.path.join(path, sub)) and
+                       (not follow or first_visit(inode_key(os.path.join(path, sub))))]
+      for file in files:
+        if not follow or first_visit(inode_key(os.path.join(path, file))):
+          yield os.path.join(path, file)
+    return
+
+  stack = [top]
+  while stack:
+    path = stack.pop()
+    try:
+      entries = list(os.scandir(path))
+      dev = os.stat(path).st_dev if follow else None
+    except OSError:
+      continue
+
+    subfolders = []
+    for entry in entries:
+      try:
+        if entry.is_dir(follow_symlinks=follow):
+          if not prune_dir(entry.name, entry.path) and (not follow or first_visit(inode_key(entry.path))):
+            subfolders.append(entry.path)
+          continue
+        if entry.is_symlink():
+          if not follow and entry.is_dir(): # os.walk doesn't follow these either
+            continue
+          if follow and not first_visit(inode_key(entry.path)):
+            continue
+        elif follow and not first_visit((dev, entry.inode())): # a plain file lives on the device of its directory
+          continue
+      except OSError:
+        continue
+      yield entry.path
+
+    subfolders.reverse()
+    stack.extend(subfolders)
 
 file_list = []
-results = []
+results = collections.OrderedDict()
 
-if not args.file_list:
-  for wk in os.walk(root_dir):
-    (path, subfolders, files) = wk
-    if fnmatch.fnmatch(path, "*/.git*"):
-      continue
-    for file in files:
-      abs_file = os.path.join(path, file)
-      file_list.append(abs_file)
-else:
+## paths as the os gives them, bytes that aren't valid in the file system encoding survive as surrogates, like os.walk does
+fs_path = getattr(os, 'fsdecode', lambda path: path)
+
+# read the candidates from the index, which is way cheaper than crawling the tree
+def git_files(top, dirs):
+  pathspecs = [os.path.relpath(os.path.join(top, dir), top) for dir in dirs]
+  try:
+    files   = fs_path(subprocess.check_output(["git", "-C", top, "ls-files", "-z", "--cached", "--others", "--exclude-standard", "--"] + pathspecs))
+    deleted = fs_path(subprocess.check_output(["git", "-C", top, "ls-files", "-z", "--deleted", "--"] + pathspecs))
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+  # tracked files can still be in pruned directories, e.g. a vendored tree
+  pruned = {'': False}
+  def in_pruned(dir):
+    if dir not in pruned:
+      (parent, name) = os.path.split(dir)
+      pruned[dir] = in_pruned(parent) or prune_dir(name, os.path.join(top, dir))
+    return pruned[dir]
+
+  deleted = set(deleted.split('\0'))
+  return [os.path.join(top, file) for file in files.split('\0') if file and file not in deleted and not in_pruned(os.path.dirname(file))]
+
+# a manifest as written by `find -print0` or a build system, NUL or newline delimited
+def read_manifest(source):
+  if source == '-':
+    manifest = getattr(sys.stdin, 'buffer', sys.stdin)
+  else:
+    manifest = open(source, 'rb')
+
+  try:
+    separator = None
+    rest = b''
+    while True:
+      data = manifest.read(chunk_size)
+      if separator is None:
+        separator = b'\0' if b'\0' in data else b'\n'
+      if not data:
+        break
+      lines = (rest + data).split(separator)
+      rest = lines.pop()
+      for line in lines:
+        file = line.rstrip(b'\r')
+        if file:
+          yield os.path.abspath(fs_path(file))
+
+    file = rest.rstrip(b'\r\n')
+    if file:
+      yield os.path.abspath(fs_path(file))
+  finally:
+    if source != '-':
+      manifest.close()
+
+# the files in the known report locations, a few directory listings instead of a crawl
+def known_files(top):
+  patterns = []
+  for fr in frameworks:
+    patterns += [pat for pat in known_report_dirs.get(fr, []) if pat not in patterns]
+
+  files = []
+  known = set()
+  for pat in patterns:
+    for path in sorted(glob.glob(os.path.join(top, pat))):
+      for abs_file in (walk_files(path) if os.path.isdir(path) else [path]):
+        if abs_file not in known:
+          known.add(abs_file)
+          files.append(abs_file)
+  return files
+
+## where the files come from, they get streamed through the classification below
+file_source = None
+known_search = False
+if args.file_list:
+  file_source = []
   for file in args.file_list:
     abs = os.path.abspath(file)
     if not os.path.isfile(abs):
       print(bcolors.FAIL + "Could not find file '" + file + "'" + bcolors.ENDC)
       exit(1)
     else:
-      file_list.append(abs)
+      file_source.append(abs)
 
+elif args.file_list_from:
+  file_source = read_manifest(args.file_list_from)
 
-for abs_file in file_list:
-  if match_file(abs_file, args.include):
-    content = None
+elif args.discovery == "git":
+  file_source = git_files(root_dir, args.output_dir)
+  if file_source is None:
+    print(bcolors.WARNING + "Could not read the git index, searching the whole root dir." + bcolors.ENDC)
+  else:
+    known = set(file_source)
+    for dir in args.allow_ignored:
+      for abs_file in walk_files(os.path.join(root_dir, dir)):
+        if abs_file not in known:
+          known.add(abs_file)
+          file_source.append(abs_file)
+
+elif args.discovery == "known":
+  explicit = args.include != include_default or len(pattern_sets) > 1
+  if not explicit:
+    print(bcolors.OKBLUE + "    Searching known report locations" + bcolors.ENDC)
+    file_source = known_files(root_dir)
+    if not any('include' in classify(abs_file) for abs_file in file_source):
+      print(bcolors.WARNING + "No reports in the known locations, searching the whole root dir." + bcolors.ENDC)
+      file_source = None
+    else: # the server still wants to see the sources to resolve the paths in the reports
+      known_search = True
+      known = set(file_source)
+      listed = git_files(root_dir, [])
+      if listed is None:
+        print(bcolors.WARNING + "Could not read the git index, walking the root dir for the file list." + bcolors.ENDC)
+        listed = walk_files(root_dir)
+      file_list.extend(abs_file for abs_file in listed if abs_file not in known)
+
+if file_source is None:
+  file_source = walk_files(root_dir)
+
+## reports outside the root dir, every root gets walked on its own thread.
+## A file reachable from several roots is only kept once, under the first path seen.
+scan_roots = []
+if not args.file_list and not args.file_list_from:
+  for root in args.scan_root + ([search_in] if search_in else []):
+    root = os.path.abspath(os.path.expanduser(root))
+    if not os.path.isdir(root):
+      print(bcolors.WARNING + "Scan root " + root + " is not a directory, skipping it." + bcolors.ENDC)
+    elif root not in scan_roots:
+      scan_roots.append(root)
+
+def merge_roots(file_source, roots):
+  if ThreadPoolExecutor is not None:
+    pool = ThreadPoolExecutor(max_workers=len(roots))
+    walks = [pool.submit(lambda root=root: list(walk_files(root))).result for root in roots]
+    pool.shutdown(wait=False)
+  else:
+    walks = [lambda root=root: walk_files(root) for root in roots]
+
+  seen = set()
+  for files in [lambda: file_source] + walks:
+    for abs_file in files():
+      real = os.path.realpath(abs_file)
+      if real not in seen:
+        seen.add(real)
+        yield abs_file
+
+if scan_roots:
+  print(bcolors.OKBLUE + "    Scan roots: " + ', '.join(scan_roots) + bcolors.ENDC)
+  file_source = merge_roots(file_source, scan_roots)
+
+## anything older than the build window is left over from earlier jobs
+since = None
+if args.since == "job":
+  since = started_at
+  if since is None:
+    print(bcolors.WARNING + "No job start found in " + args.id_file + ", not filtering by modification time." + bcolors.ENDC)
+elif args.since:
+  try:
+    since = float(args.since)
+  except ValueError:
+    print(bcolors.FAIL + "Invalid time for --since: '" + args.since + "'" + bcolors.ENDC)
+    exit(1)
+
+def is_stale(abs_file):
+  try:
+    return since is not None and os.stat(abs_file).st_mtime < since
+  except OSError:
+    return False
+
+framework_files = dict((framework, []) for framework in incl_frameworks)
+tool_files = dict((tool, []) for tool in tools)
+
+archive_pattern = compile_patterns(args.archive)
+
+def is_archive(abs_file):
+  file = os.path.normcase(rel_path(abs_file))
+  file_abs = os.path.normcase(abs_file)
+  return match_patterns(archive_pattern, file, file_abs) and not match_patterns(exclude_pattern, file, file_abs)
 
-    ext = os.path.splitext(abs_file)[1].lower()
-    binary_content = open(abs_file, "rb").read()
+def member_path(archive_abs, name):
+  parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+  if not parts or '..' in parts:
+    return None
+  return os.path.join(archive_abs, *parts)
+
+# yields the members of an archive the patterns pick
+def archive_files(archive_abs):
+  try:
+    if zipfile.is_zipfile(archive_abs):
+      with zipfile.ZipFile(archive_abs) as archive:
+        for info in archive.infolist():
+          member = member_path(archive_abs, info.filename)
+          if member is not None and not info.filename.endswith('/') and classify(member):
+            archive_members[member] = (archive_abs, info.filename)
+            member_archives[member] = archive_abs
+            yield member
+    else:
+      with tarfile.open(archive_abs, "r|*") as archive:
+        for info in archive:
+          member = member_path(archive_abs, info.name)
+          if member is not None and info.isfile() and classify(member):
+            archive_members[member] = (None, spill_member(archive.extractfile(info)))
+            member_archives[member] = archive_abs
+            yield member
+  except (tarfile.TarError,) + read_errors as e:
+    print(bcolors.WARNING + "Could not read archive " + archive_abs + ": " + str(e) + bcolors.ENDC)
+
+# yields the candidates for detection, while sorting the rest into their buckets
+def discover(file_source):
+  for abs_file in file_source:
+    file_list.append(abs_file)
+    if is_archive(abs_file):
+      members = archive_files(abs_file) if not is_stale(abs_file) else []
+    else:
+      members = [abs_file]
+
+    for member in members:
+      buckets = classify(member)
+      if buckets and is_stale(member):
+        continue
+      for bucket in buckets:
+        if bucket == 'include':
+          yield member
+        elif bucket[0] == 'framework':
+          framework_files[bucket[1]].append(member)
+        else:
+          tool_files[bucket[1]].append(member)
+
+candidates = discover(file_source)
+
+## enough to see the signatures of all frameworks, only reports get read completely
+sniff_size = 8192
+
+## everything is handled as utf-8 bytes, which is what goes into the request body
+bom_encodings = [(codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF8, 'utf-8-sig'),
+                 (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+xml_encoding = re.compile(br'<\?xml[^>]*?encoding\s*=\s*["\']([-\w.:]+)["\']')
+
+def detect_encoding(binary_head):
+  for (bom, encoding) in bom_encodings:
+    if binary_head.startswith(bom):
+      return encoding
+  if binary_head.startswith(b'<\0?\0'):
+    return 'utf-16-le'
+  if binary_head.startswith(b'\0<\0?'):
+    return 'utf-16-be'
+
+  # the declaration was found as single bytes, so only ascii compatible encodings can be right.
+  # .NET tools like to declare utf-16 on utf-8 files.
+  match = xml_encoding.match(binary_head)
+  if match:
     try:
-      content = binary_content.decode('ascii')
-    except UnicodeDecodeError:
-      try:
-        content = binary_content.decode('utf-8').encode("ascii","ignore").decode('ascii')
-      except UnicodeDecodeError:
-        try:
-          content = binary_content.decode('utf-16').encode("ascii","ignore").decode('ascii')
-        except UnicodeDecodeError:
-          print(bcolors.FAIL + "Can't figure out encoding of file " + abs_file + ", ignoring it" + bcolors.ENDC)
+      encoding = codecs.lookup(match.group(1).decode('ascii')).name
+    except LookupError:
+      return 'utf-8'
+    if codecs.encode(u'<?xml encoding', encoding) == b'<?xml encoding':
+      return encoding
+  return 'utf-8'
+
+# utf-8 & ascii are only validated and passed through, anything else is decoded once and reencoded.
+# final=False allows a character to be cut off at the end, as happens with a prefix.
+def to_utf8(binary_content, encoding, final=True):
+  if encoding == 'utf-8-sig':
+    (binary_content, encoding) = (binary_content[len(codecs.BOM_UTF8):], 'utf-8')
+
+  if encoding in ['utf-8', 'ascii']:
+    if not getattr(binary_content, 'isascii', lambda: False)():
+      codecs.getincrementaldecoder('utf-8')().decode(binary_content, final)
+    return binary_content
+
+  return codecs.getincrementaldecoder(encoding)().decode(binary_content, final).encode('utf-8')
+
+## big reports are mapped instead of read for the marker scans, the pages are only touched as they are scanned.
+## Only plain utf-8 files on disk qualify, anything else needs to be decoded anyway.
+mmap_threshold = 4 * 1024 * 1024
+mmap_chunk = 1024 * 1024
+
+def map_report(abs_file, file, encoding):
+  if encoding not in ['utf-8', 'ascii'] or abs_file in archive_members or strip_compression(abs_file) is not None:
+    return None
+  try:
+    if os.fstat(file.fileno()).st_size < mmap_threshold:
+      return None
+    content = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (ValueError, EnvironmentError):
+    return None
+
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  for pos in range(0, len(content), mmap_chunk):
+    decoder.decode(content[pos:pos + mmap_chunk])
+  decoder.decode(b'', True)
+  return content
+
+## marker strings looked for anywhere in a report, all of them found in one pass over the content
+def compile_markers(markers):
+  ordered = sorted(markers, key=len, reverse=True)
+  # matching inside a lookahead finds overlapping markers as well
+  return (re.compile(b'(?=(' + b'|'.join(re.escape(marker) for marker in ordered) + b'))'), markers)
+
+def scan_markers(content, scanner, done=lambda found: False):
+  (pattern, markers) = scanner
+  found = set()
+  for match in pattern.finditer(content):
+    found.add(markers[match.group(1)])
+    if done(found):
+      break
+  return found
+
+qtest_markers = compile_markers({b'<QtVersion>': 'qt', b'<qtversion>': 'qt'})
+
+xunit_markers = compile_markers({
+  b'"java.version"': 'java',
+  b'org.junit':  'junit',  b'org/junit':  'junit',  b'org\\junit':  'junit',
+  b'org.testng': 'testng', b'org/testng': 'testng', b'org\\testng': 'testng',
+  b'<testsuite name="bandit" tests="': 'bandit',
+  b'.php': 'php',
+  b'.py':  'py'
+})
+
+def xunit_framework(found):
+  if 'java' in found and 'junit' in found:
+    return 'junit'
+  elif 'java' in found and 'testng' in found:
+    return 'testng'
+  elif 'java' not in found and 'bandit' in found:
+    return 'bandit'
+  elif 'php' in found:
+    return 'phpunit'
+  elif 'py' in found:
+    return 'pytest'
+  else:
+    return 'xunit'
+
+## go test writes one json record per line, the first one tells
+json_line_limit = 1024 * 1024
+
+def first_line(chunks, limit):
+  line = b''
+  for chunk in chunks:
+    end = chunk.find(b'\n')
+    if end != -1:
+      return line + chunk[:end]
+    line += chunk
+    if len(line) > limit:
+      return None
+  return line
+
+## rspec & mocha are told apart by their top-level keys, in any order. The values in between are skipped, not parsed.
+json_keys = [
+  ('rspec', ["version", "examples", "summary", "summary_line"]),
+  ('mocha', ["stats", "tests", "pending", "passes", "failures"])
+]
+# any other top-level key means it's not a report, e.g. a package-lock.json
+json_known_keys = set(key for (framework, required) in json_keys for key in required) | set(["seed", "messages"])
+
+json_string_end = re.compile(br'["\\]')
+json_structure  = re.compile(br'["{}\[\],]')
+
+# yields the keys of a top-level json object in order, without building any of the values
+def json_top_keys(chunks):
+  depth = 0
+  in_string = False
+  escaped = False
+  expect_key = False
+  key = None
+  for chunk in chunks:
+    pos = 0
+    if escaped:
+      if key is not None:
+        key += b'\\' + chunk[:1]
+      (pos, escaped) = (1, False)
+
+    while pos < len(chunk):
+      if in_string:
+        match = json_string_end.search(chunk, pos)
+        end = match.start() if match else len(chunk)
+        if key is not None:
+          key += chunk[pos:end]
+        if match is None:
+          break
+        if chunk[end:end + 1] == b'\\':
+          if end + 1 == len(chunk):
+            escaped = True
+          elif key is not None:
+            key += chunk[end:end + 2]
+          pos = end + 2
           continue
 
-    if ext == ".xml":
-      if re.match(r"(<\?[^?]*\?>\s*)?<(?:TestResult|TestLog)>\s*<TestSuite", content):
-        print("    Found " + abs_file + " looks like boost.test")
-        results.append({'rawData': content, 'framework': 'boost', 'filename': abs_file})
+        in_string = False
+        pos = end + 1
+        if key is not None:
+          yield json.loads((b'"' + key + b'"').decode('utf-8'))
+          (key, expect_key) = (None, False)
         continue
 
-      if re.match(r"(<\?[^?]*\?>\s*)?<TestCase", content) and (content.find("<QtVersion>") != -1 or content.find("<qtversion>") != -1):
-        print("    Found " + abs_file + ", looks like qtest")
-        results.append({'rawData': content, 'framework': 'qtest', 'filename': abs_file})
+      match = json_structure.search(chunk, pos)
+      if match is None:
+        break
+      char = match.group()
+      pos = match.end()
+      if char == b'"':
+        in_string = True
+        if depth == 1 and expect_key:
+          key = b''
+      elif char in b'{[':
+        if depth == 0 and char == b'[':
+          return
+        depth += 1
+        expect_key = depth == 1
+      elif char in b']}':
+        depth -= 1
+        if depth == 0:
+          return
+      elif depth == 1:
+        expect_key = True
+
+def probe_json_keys(keys):
+  seen = set()
+  for key in keys:
+    if key not in json_known_keys:
+      return None
+    seen.add(key)
+    for (framework, required) in json_keys:
+      if seen.issuperset(required):
+        return framework
+  return None
+
+# figure out which framework wrote the file from its header, None if it's not a test report.
+# load gives the complete content, for the checks that need more than the header, stream yields it chunk by chunk.
+def detect_framework(ext, head, load, stream):
+  if ext == ".xml":
+    if re.match(br"(<\?[^?]*\?>\s*)?<(?:TestResult|TestLog)>\s*<TestSuite", head):
+      return 'boost'
+
+    if re.match(br"(<\?[^?]*\?>\s*)?<TestCase", head):
+      if scan_markers(load(), qtest_markers, lambda found: True):
+        return 'qtest'
+
+    if re.match(br'(<\?[^?]*\?>\s*)?<!-- Tests compiled with Criterion v[0-9.]+ -->\s*<testsuites name="Criterion Tests"', head):
+      return 'criterion'
+
+    if re.match(br"(<\?[^?]*\?>\s*)?(<testsuites>\s*)?<testsuite[^>]", head): #xUnit thingy
+      # junit is the only verdict that can't be overruled by markers further down
+      return xunit_framework(scan_markers(load(), xunit_markers, lambda found: 'java' in found and 'junit' in found))
+
+    if re.match(br'(<\?[^?]*\?>\s*)?<Catch\s+name=', head):
+      return 'catch'
+    if re.match(br'(<\?[^?]*\?>\s*)?<stream>\s*<ready-test-suite>', head):
+      return 'testunit'
+    if re.match(br'(<\?[^?]*\?>\s*)?(<!--This file represents the results of running a test suite-->)?<test-results\s+name', head) or \
+       re.match(br'(<\?[^?]*\?>\s*)?<test-run id="2"', head):
+      return 'nunit'
+    if re.match(br'(<\?[^?]*\?>)?\s*<assemblies', head):
+      return 'xunitnet'
+    if re.match(br'(<\?[^?]*\?>)?\s*<doctest', head):
+      return 'doctest'
+
+  elif ext == ".json" and re.match(br"\s*({|\[)", head): #Might be JSON, let's see if it fits go
+    try:
+      record = json.loads(first_line(stream(), json_line_limit))
+      if all(val in record for val in ["Time", "Action", "Package"]): #assumption
+        return 'go-test'
+    except:
+      pass
+    try:
+      return probe_json_keys(json_top_keys(stream()))
+    except:
+      pass
 
-        continue
+  elif ext == ".trx" and re.match(br"(<\?[^?]*\?>\s*)?<TestRun", head):
+    return 'mstest'
 
-      if re.match(r'(<\?[^?]*\?>\s*)?<!-- Tests compiled with Criterion v[0-9.]+ -->\s*<testsuites name="Criterion Tests"', content):
-        print("    Found " + abs_file + ", looks like criterion")
-        results.append({'rawData': content, 'framework': 'criterion', 'filename': abs_file})
-        continue
+  elif ext == ".tap" and re.match(br"TAP version \d+", head): # is Test anything protocol
+    if re.match(br"ava[\\\/]cli.js", head):
+      return 'ava'
+    else:
+      return 'tap'
 
-      if re.match(r"(<\?[^?]*\?>\s*)?(<testsuites>\s*)?<testsuite[^>]", content): #xUnit thingy
-        if content.find('"java.version"') != -1 and (content.find('org.junit') != -1 or content.find('org/junit') != -1 or content.find('org\\junit') != -1):
-          print("    Found " + abs_file + ", looks like JUnit")
-          results.append({'rawData': content, 'framework': 'juni', 'filename': abs_file})
-        elif content.find('"java.version"') != -1 and (content.find('org.testng') != -1 or content.find('org/testng') != -1 or content.find('org\    estng') != -1):
-          print("    Found " + abs_file + ", looks like TestNG")
-          results.append({'rawData': content, 'framework': 'testng', 'filename': abs_file})
-        elif content.find('"java.version"') == -1 and content.find('<testsuite name="bandit" tests="') != -1:
-          print("    Found " + abs_file + ", looks like Bandit")
-          results.append({'rawData': content, 'framework': 'bandit', 'filename': abs_file})
-        elif content.find('.php') != -1:
-          print("    Found " + abs_file + ", looks like PHPUnit")
-          results.append({'rawData': content, 'framework': 'phpunit', 'filename': abs_file})
-        elif content.find('.py') != -1:
-          print("    Found " + abs_file + ", looks like PyTest")
-          results.append({'rawData': content, 'framework': 'pytest', 'filename': abs_file})
-        else:
-          print("    Found " + abs_file + ", looks like some xUnit")
-          results.append({'rawData': content, 'framework': 'xunit', 'filename': abs_file})
-        continue
+  return None
 
+chunk_size = 65536
 
-      if re.match(r'(<\?[^?]*\?>\s*)?<Catch\s+name=', content):
-        print("    Found " + abs_file + ", looks like catch")
-        results.append({'rawData': content, 'framework': 'catch', 'filename': abs_file})
-        continue
-      if re.match(r'(<\?[^?]*\?>\s*)?<stream>\s*<ready-test-suite>', content):
-        print("    Found " + abs_file + ", looks like TestUnit")
-        results.append({'rawData': content, 'framework': 'testunit', 'filename': abs_file})
-        continue
-      if re.match(r'(<\?[^?]*\?>\s*)?(<!--This file represents the results of running a test suite-->)?<test-results\s+name', content) or \
-         re.match(r'(<\?[^?]*\?>\s*)?<test-run id="2"', content):
-        print("    Found " + abs_file + ", looks like NUnit")
-        results.append({'rawData': content, 'framework': 'nunit', 'filename': abs_file})
-        continue
-      if re.match(r'(<\?[^?]*\?>)?\s*<assemblies', content):
-        print("    Found " + abs_file + ", looks like xUnit.net")
-        results.append({'rawData': content, 'framework': 'xunitnet', 'filename': abs_file})
-        continue
+# sniff the header of a file and read the rest only if needed, gives the framework
+def sniff_encoded(abs_file, encoding):
+  file = open_report(abs_file)
+  try:
+    binary_head = file.read(sniff_size)
+    encoding = encoding or detect_encoding(binary_head)
+    loaded = []
+    def load():
+      if not loaded:
+        content = map_report(abs_file, file, encoding)
+        if content is None:
+          file.seek(0)
+          content = to_utf8(file.read(), encoding)
+        loaded.append(content)
+      return loaded[0]
+
+    def stream():
+      file.seek(0)
+      decoder = None
+      if encoding not in ['utf-8', 'utf-8-sig', 'ascii']:
+        decoder = codecs.getincrementaldecoder(encoding)()
+      while True:
+        data = file.read(chunk_size)
+        if not data:
+          return
+        yield data if decoder is None else decoder.decode(data).encode('utf-8')
+
+    head = to_utf8(binary_head, encoding, final=len(binary_head) < sniff_size)
+    return detect_framework(report_ext(abs_file), head, load, stream)
+  finally:
+    file.close()
+
+# a file that doesn't decode with the encoding it declares is tried as utf-8
+def sniff_file(abs_file):
+  try:
+    return sniff_encoded(abs_file, None)
+  except UnicodeError:
+    return sniff_encoded(abs_file, 'utf-8')
 
-      if re.match(r'(<\?[^?]*\?>)?\s*<doctest', content):
-        print("    Found " + abs_file + ", looks like doctest")
-        results.append({'rawData': content, 'framework': 'doctest', 'filename': abs_file})
-        continue
+## detection verdicts of earlier runs, keyed by path and validated by (inode, size, mtime)
+cache_version = 6
+cache_size = 100000
+cache = collections.OrderedDict()
+cache_file = args.cache_file or os.path.join(os.path.dirname(args.id_file), ".report-ci-cache.json")
 
+if not args.no_cache:
+  try:
+    cache_data = json.loads(open(cache_file, "r").read())
+    if cache_data["version"] == cache_version:
+      cache.update((abs_file, entry) for (abs_file, entry) in cache_data["entries"])
+  except:
+    pass
 
-    elif ext == ".json" and re.match(r"\s*({|\[)", content): #Might be JSON, let's see if it fits go
-      try:
-        lines = content.splitlines()
-        json_lines = [json.loads(ln) for ln in lines]
-        if all(val in json_lines[0] for val in ["Time", "Action", "Package"]): #assumption
-          print("Found " + abs_file + ", looks like GoTest")
-          results.append({'rawData':  content, 'framework': 'go-test', 'filename': abs_file})
-          continue
-      except:
-        pass
-      try:
-        data = json.loads(content)
+def file_key(abs_file):
+  st = os.stat(member_archives.get(abs_file, abs_file))
+  return [st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)]
 
-        if "version" in data and "examples" in data and "summary" in data and "summary_line" in data :
-          print("Found " + abs_file + ", looks like RSpec")
-          results.append({'rawData': content, 'framework': 'rspec', 'filename': abs_file})
-          continue
-        if "stats" in data and "tests" in data and "pending" in data and "passes" in data and "failures" in data:
-          print("Found " + abs_file + ", looks like Mocha")
-          results.append({'rawData': content, 'framework': 'mocha', 'filename': abs_file})
-          continue
-      except:
-        pass
+# stat & sniff a candidate, gives (file, key, framework, error). Runs on the worker threads or processes.
+def ingest(abs_file):
+  try:
+    key = file_key(abs_file)
+  except OSError:
+    return (abs_file, None, None, "Could not find file '" + abs_file + "'")
 
-    elif ext == ".trx" and re.match(r"(<\?[^?]*\?>\s*)?<TestRun", content):
-      print("Found " + abs_file + ", looks like MsTest")
-      results.append({'rawData': content, 'framework': 'mstest', 'filename': abs_file})
+  try:
+    entry = cache.get(abs_file)
+    if entry is not None and entry[:3] == key:
+      framework = entry[3]
+    else:
+      framework = sniff_file(abs_file)
+  except UnicodeError:
+    return (abs_file, key, None, "Can't figure out encoding of file " + abs_file + ", ignoring it")
+  except read_errors as e:
+    return (abs_file, key, None, "Could not read " + abs_file + ": " + str(e))
+
+  return (abs_file, key, framework, None)
+
+## the contents are only read when the request body gets written, one chunk at a time
+class ReportSource(object):
+  def __init__(self, abs_file):
+    self.abs_file = abs_file
+    self.measured = None
+
+  # every byte ends up as at most 6 in the body, e.g. \u001f, which saves reading the file.
+  # Compressed files & archive members can't tell without being read.
+  def size_bound(self):
+    if self.abs_file in archive_members or strip_compression(self.abs_file) is not None:
+      return None
+    return 6 * os.path.getsize(self.abs_file)
+
+  # the size in the body, decompressed & escaped
+  def json_size(self):
+    if self.measured is None:
+      self.measured = sum(len(escape_json(chunk)) for chunk in self.chunks())
+    return self.measured
+
+  def digest(self):
+    sha = hashlib.sha256()
+    for chunk in self.chunks():
+      sha.update(chunk)
+    return "sha256:" + sha.hexdigest()
+
+  # the utf-8 content, part of the body might be out already when a bad character shows up, so it gets replaced
+  def chunks(self):
+    try:
+      file = open_report(self.abs_file)
+      try:
+        data = file.read(chunk_size)
+        encoding = detect_encoding(data[:sniff_size])
+        if encoding == 'utf-8-sig':
+          (data, encoding) = (data[len(codecs.BOM_UTF8):], 'utf-8')
+
+        passthrough = encoding in ['utf-8', 'ascii']
+        if passthrough:
+          encoding = 'utf-8'
+        decoder = codecs.getincrementaldecoder(encoding)()
+        while data:
+          try:
+            text = decoder.decode(data)
+          except UnicodeError:
+            print(bcolors.WARNING + "Can't figure out encoding of file " + self.abs_file + ", replacing what can't be decoded" + bcolors.ENDC)
+            decoder = codecs.getincrementaldecoder(encoding)('replace')
+            (text, passthrough) = (decoder.decode(data), False)
+          yield data if passthrough else text.encode('utf-8')
+          data = file.read(chunk_size)
+        if not passthrough:
+          yield decoder.decode(b'', True).encode('utf-8')
+      finally:
+        file.close()
+    except read_errors as e:
+      print(bcolors.FAIL + "Could not read " + self.abs_file + ": " + str(e) + bcolors.ENDC)
+
+# the cgroup quota is what we'll actually get on a container, not the cores of the host
+def cpu_quota():
+  try:
+    (quota, period) = open("/sys/fs/cgroup/cpu.max").read().split()
+    if quota != "max":
+      return max(1, int(math.ceil(float(quota) / float(period))))
+  except:
+    pass
+  try:
+    quota  = int(open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read())
+    period = int(open("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read())
+    if quota > 0:
+      return max(1, int(math.ceil(float(quota) / float(period))))
+  except:
+    pass
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+jobs = args.jobs or min(32, 4 * cpu_quota()) # reading is mostly waiting on I/O
+
+verdicts = collections.OrderedDict()
+def collect(records):
+  for (abs_file, key, framework, error) in records:
+    if error:
+      print(bcolors.FAIL + error + bcolors.ENDC)
+    if key is None:
+      continue
+    verdicts[abs_file] = key + [framework]
+    if framework is None:
+      continue
 
-    elif ext == ".tap" and re.match(r"TAP version \d+", content): # is Test anything protocol
+    print("    Found " + abs_file + ", looks like " + framework_names[framework])
+    results[abs_file] = {'rawData': ReportSource(abs_file), 'framework': framework, 'filename': abs_file}
 
-      if re.match(r"ava[\\\/]cli.js", content):
-        print("Found " + abs_file + ", looks like AVA")
-        results.append({'rawData': content, 'framework': 'ava', 'filename': abs_file})
-      else:
-        print("Found " + abs_file + ", looks like TAP")
-        results.append({'rawData': content, 'framework': 'tap', 'filename': abs_file})
+## detection is cpu bound on large report sets, so it can be sharded across processes.
+## forking is required, spawning would rerun this whole script in every worker.
+process_context = None
+if args.processes is not None:
+  try:
+    if sys.version_info < (3, 7): # ProcessPoolExecutor doesn't take a context before
+      raise ValueError("no mp_context")
+    process_context = multiprocessing.get_context("fork")
+  except (AttributeError, ValueError):
+    print(bcolors.WARNING + "Process based detection is not available on this platform, using threads." + bcolors.ENDC)
+
+def detect(candidates):
+  if process_context is not None and ProcessPoolExecutor is not None:
+    candidates = list(candidates)
+    processes = args.processes or cpu_quota()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=process_context) as pool:
+      collect(pool.map(ingest, candidates, chunksize=max(1, len(candidates) // (processes * 4))))
+  elif ThreadPoolExecutor is None or jobs <= 1:
+    collect(map(ingest, candidates))
+  else:
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+      collect(pool.map(ingest, candidates))
+
+detect(candidates)
+
+## nothing in the known locations turned out to be a report, e.g. just a coverage.xml, so it's the whole tree after all
+if known_search and not results:
+  print(bcolors.WARNING + "No reports detected in the known locations, searching the whole root dir." + bcolors.ENDC)
+  del file_list[:]
+  visited.clear()
+  file_source = walk_files(root_dir)
+  if scan_roots:
+    file_source = merge_roots(file_source, scan_roots)
+  detect(discover(file_source))
+
+if not args.no_cache:
+  for abs_file in verdicts:
+    cache.pop(abs_file, None)
+  cache.update(verdicts)
+  try:
+    entries = list(cache.items())[-cache_size:]
+    open(cache_file, 'w').write(json.dumps({"version": cache_version, "entries": entries}))
+  except:
+    print(bcolors.WARNING + "Could not write the detection cache " + cache_file + bcolors.ENDC)
 
-incl_frameworks = [arg[len('--include-as-'):] for arg in sys.argv if arg.startswith('--include-as-')]
-incl_frameworks.reverse()
 for framework in incl_frameworks:
-  incl = getattr(args, 'include_as_' + framework.replace('-', '_'))
-  if incl is None:
-    continue
-
-  for abs_file in (abs_file for abs_file in file_list if match_file(abs_file, incl)):
+  for abs_file in framework_files[framework]:
     ##check if it's already in the list
-    try:
-      next(res for res in results if res['filename'] == abs_file)['framework'] = framework
-    except StopIteration:
-      content = open(abs_file).read()
-      results.append({'rawData': content, 'framework': framework, 'filename': abs_file})
+    if abs_file in results:
+      results[abs_file]['framework'] = framework
+    else:
+      results[abs_file] = {'rawData': ReportSource(abs_file), 'framework': framework, 'filename': abs_file}
 
 logs = []
 for tool in tools:
-  incl = getattr(args, 'log_as_' + tool)
-
-  if incl is None:
-    continue
-
-  for abs_file in (abs_file for abs_file in file_list if match_file(abs_file, incl)):
-    content = open(abs_file).read()
-    logs.append({'rawData': content, 'tool': tool, 'logName': abs_file})
+  for abs_file in tool_files[tool]:
+    logs.append({'rawData': ReportSource(abs_file), 'tool': tool, 'logName': abs_file})
 
 for fr in frameworks:
-  cnt = len([res for res in results if res["framework"] == fr])
+  cnt = len([res for res in results.values() if res["framework"] == fr])
   if cnt > 0:
     print(bcolors.HEADER + str(cnt) + " files for "+  framework_names[fr] + bcolors.ENDC)
 
 
+## the utf-8 contents go into the body as they are, only the characters json needs escaped get replaced
+json_escapes = dict((bytes(bytearray([ch])), json.dumps(chr(ch))[1:-1].encode('ascii')) for ch in range(0x20))
+json_control = re.compile(b'[\x00-\x1f]')
+
+def escape_json(value):
+  value = value.replace(b'\\', b'\\\\').replace(b'"', b'\\"').replace(b'\n', b'\\n').replace(b'\r', b'\\r').replace(b'\t', b'\\t')
+  return json_control.sub(lambda match: json_escapes[match.group()], value)
+
+def encode_json_string(value):
+  return b'"' + escape_json(value) + b'"'
+
+# yields the body piece by piece, the reports are escaped chunk by chunk straight from their files
+def encode_json(value, read=ReportSource.chunks):
+  if isinstance(value, ReportSource):
+    yield b'"'
+    for chunk in read(value):
+      yield escape_json(chunk)
+    yield b'"'
+  elif isinstance(value, bytes):
+    yield encode_json_string(value)
+  elif isinstance(value, (dict, list)):
+    items = value.items() if isinstance(value, dict) else enumerate(value)
+    yield b'{' if isinstance(value, dict) else b'['
+    for (index, (key, val)) in enumerate(items):
+      if index:
+        yield b', '
+      if isinstance(value, dict):
+        yield json.dumps(key).encode('utf-8') + b': '
+      for chunk in encode_json(val, read):
+        yield chunk
+    yield b'}' if isinstance(value, dict) else b']'
+  else:
+    yield json.dumps(value).encode('utf-8')
+
+# http.client sends every piece as a chunk of its own, so they get bundled up
+def buffered(pieces, size=chunk_size):
+  (buffer, length) = ([], 0)
+  for piece in pieces:
+    buffer.append(piece)
+    length += len(piece)
+    if length >= size:
+      yield b''.join(buffer)
+      (buffer, length) = ([], 0)
+  if buffer:
+    yield b''.join(buffer)
+
 content_type = "application/json"
-upload_content = json.dumps({'files': file_list, "logs": logs, "results": results, "meta": meta})
 
+## what went up to the check run so far, kept next to the id file.
+## A report is identified by the (inode, size, mtime) of its file, like the detection cache does.
+## Our own files come and go between the runs, so they don't count.
+state_file = args.state_file or os.path.join(os.path.dirname(args.id_file), ".report-ci-state.json")
+blob_index_file = args.blob_index or os.path.join(os.path.dirname(args.id_file), ".report-ci-blobs.json")
+own_files = set(os.path.abspath(file) for file in [args.id_file, cache_file, state_file, blob_index_file])
+
+state = {"check-run": None, "shards": [], "reports": {}}
+try:
+  recorded = json.loads(open(state_file, "r").read())
+  if args.check_run is not None and str(recorded["check-run"]) == str(args.check_run):
+    state.update(recorded)
+except:
+  pass
+
+def entry_file(entry):
+  return entry.get('filename', entry.get('logName'))
+
+def entry_identity(entry):
+  abs_file = entry_file(entry)
+  try:
+    key = file_key(abs_file)
+  except OSError:
+    key = None
+  return [abs_file, entry.get('framework', entry.get('tool')), key]
+
+def entry_digest(entry):
+  return hashlib.sha1(json.dumps(entry_identity(entry)).encode('utf-8')).hexdigest()
+
+## with --delta the reports & logs already in the check run are left out.
+## That needs a server that keeps them through the PATCH, like --shard does.
+if args.delta and state["reports"]:
+  sent = set(entry_file(entry) for entry in list(results.values()) + logs if state["reports"].get(entry_file(entry)) == entry_digest(entry))
+  if sent:
+    print(bcolors.OKBLUE + "    " + str(len(sent)) + " files are unchanged since the last upload, leaving them out, the server has to keep them from that upload" + bcolors.ENDC)
+  results = collections.OrderedDict((abs_file, entry) for (abs_file, entry) in results.items() if abs_file not in sent)
+  logs = [entry for entry in logs if entry_file(entry) not in sent]
+  if not results and not logs:
+    print(bcolors.OKGREEN + "Nothing new to upload." + bcolors.ENDC)
+    exit(0)
+
+## with --dedup, contents the server has already are only referenced by their hash, e.g. the same junit.xml from all jobs of a matrix.
+## If the server can't tell which it has, but says it takes references, the contents uploaded from here before stand in.
+blobs_url = "https://api.report.ci/blobs/"
+blob_index_size = 100000
+blob_hashes = {}
+
+def read_blob_index():
+  try:
+    return json.loads(open(blob_index_file, "r").read())
+  except:
+    return {}
+
+def known_blobs(hashes):
+  request = Request(blobs_url + "?" + urlencode({'owner': owner, 'repo': repo}), json.dumps({'hashes': hashes}).encode('utf-8'), {})
+  request.add_header("Content-Type", "application/json")
+  if args.token: request.add_header("Authorization",  "Bearer " + args.token)
+  try:
+    answer = json.loads(urlopen(request).read().decode())
+  except Exception:
+    print(bcolors.WARNING + "The server can't tell which contents it has, sending them all" + bcolors.ENDC)
+    return set()
+  if "known" in answer:
+    return set(answer["known"])
+  if answer.get("references"):
+    print(bcolors.OKBLUE + "The server takes references but can't tell which contents it has, using the local index " + blob_index_file + bcolors.ENDC)
+    return set(read_blob_index().get(owner + '/' + repo, []))
+  return set()
+
+def record_blobs(hashes):
+  index = read_blob_index()
+  blobs = [blob for blob in index.get(owner + '/' + repo, []) if blob not in hashes] + sorted(hashes)
+  index[owner + '/' + repo] = blobs[-blob_index_size:]
+  try:
+    open(blob_index_file, 'w').write(json.dumps(index))
+  except:
+    print(bcolors.WARNING + "Could not write the blob index " + blob_index_file + bcolors.ENDC)
 
-upload_content = upload_content.strip()
-if len(upload_content) == 0:
-  print(bcolors.FAIL + " No test data to upload.")
+if args.dedup:
+  entries = list(results.values()) + logs
+  if ThreadPoolExecutor is None or jobs <= 1:
+    hashes = list(map(lambda entry: entry['rawData'].digest(), entries))
+  else:
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+      hashes = list(pool.map(lambda entry: entry['rawData'].digest(), entries))
+
+  known = known_blobs(sorted(set(hashes)))
+  for (entry, blob) in zip(entries, hashes):
+    blob_hashes[entry_file(entry)] = blob
+    if blob in known:
+      del entry['rawData']
+      entry['rawDataRef'] = blob
+  referenced = len([entry for entry in entries if 'rawDataRef' in entry])
+  if referenced:
+    print(bcolors.OKBLUE + "    " + str(referenced) + " files are known to the server already, only sending a reference" + bcolors.ENDC)
+
+## one upload takes up to 10MB, with --shard the results & logs above that get split up.
+## The first shard creates the check run, the others are patched into it in order.
+## The reports are bounded by the size of their files, only if that's not enough they're measured as they go into the body,
+## i.e. decompressed & escaped, which takes a read of their own. Compressed reports & archive members always are.
+upload_limit = 10000000
+
+def json_size(value):
+  return sum(len(piece) for piece in encode_json(value, lambda source: []))
+
+def entry_size(entry, exact):
+  source = entry.get('rawData')
+  if source is None:
+    content = 0
+  elif not exact and source.size_bound() is not None:
+    content = source.size_bound()
+  else:
+    content = source.json_size()
+  return json_size(entry) + content + len(b', ')
+
+## the file list is most of the payload on big trees. It can be limited to the sources annotations point to,
+## and with --compact-files it's sorted & relative to the root dir, and each path only gives the
+## length of the prefix it shares with the one before, followed by the rest, e.g. "0\tsrc/a.py\n4\tb.py"
+files_include_pattern = compile_patterns(args.files_include)
+if files_include_pattern is not None:
+  file_list = [file for file in file_list if match_patterns(files_include_pattern, os.path.normcase(rel_path(file)), os.path.normcase(file))]
+
+def compact_files(files):
+  prefix = os.path.join(os.path.abspath(root_dir), '')
+  lines = []
+  last = ''
+  for path in sorted(file[len(prefix):] if file.startswith(prefix) else file for file in files):
+    shared = len(os.path.commonprefix([last, path]))
+    lines.append(str(shared) + '\t' + path[shared:])
+    last = path
+  return {'root-dir': root_dir, 'front-coded': '\n'.join(lines)}
+
+upload_files = compact_files(file_list) if args.compact_files else file_list
+
+def new_shard():
+  return {'files': upload_files, "logs": [], "results": [], "meta": meta}
+
+envelope_size = json_size(new_shard())
+if envelope_size > upload_limit:
+  print(bcolors.FAIL + "Your file list is too large (10MB limit) to be uploaded." + bcolors.ENDC)
+  print(bcolors.OKBLUE + "You can work around that by restricting the search, e.g. with --discovery=git or --prune." + bcolors.ENDC)
   exit(1)
 
+entries = [('results', entry) for entry in results.values()] + [('logs', entry) for entry in logs]
+
+def entry_sizes(exact):
+  if ThreadPoolExecutor is None or jobs <= 1:
+    return list(map(lambda item: entry_size(item[1], exact), entries))
+  with ThreadPoolExecutor(max_workers=jobs) as pool:
+    return list(pool.map(lambda item: entry_size(item[1], exact), entries))
+
+sizes = entry_sizes(False)
+if envelope_size + sum(sizes) > upload_limit:
+  sizes = entry_sizes(True)
+
+if not args.shard and envelope_size + sum(sizes) > upload_limit:
+  print(bcolors.FAIL + "Your data is too large (10MB limit) to be done in one upload." + bcolors.ENDC)
+  print(bcolors.OKBLUE + "You can work around that by splitting up your test data using the --include=* argument over several invocations, or with --shard." + bcolors.ENDC)
+  exit(1)
+
+shards = [new_shard()]
+shard_size = envelope_size
+for ((kind, entry), size) in zip(entries, sizes):
+  if envelope_size + size > upload_limit:
+    print(bcolors.WARNING + entry_file(entry) + " alone is larger than the 10MB limit, the upload might get rejected." + bcolors.ENDC)
+  if shard_size + size > upload_limit and (shards[-1]['results'] or shards[-1]['logs']):
+    shards.append(new_shard())
+    shard_size = envelope_size
+  shards[-1][kind].append(entry)
+  shard_size += size
+
+## the reports are very repetitive, gzip gets them down a lot
+def gzip_pieces(pieces):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+  for piece in pieces:
+    data = compressor.compress(piece)
+    if data:
+      yield data
+  yield compressor.flush()
+
+# a new body for every attempt, as it's written while being sent
+def upload_content(shard, compressed):
+  content = buffered(gzip_pieces(encode_json(shard)) if compressed else encode_json(shard))
+  if sys.version_info < (3, 6): # chunked transfer encoding is only supported from here on
+    content = b''.join(content)
+  return content
+
 if service and not args.name and run_name:
   if os_name:
     run_name += " [" + service +  ", " + os_name + "]"
@@ -731,33 +1744,94 @@ if service and service in ["travis-ci", "appveyor", "circle-ci", "github-actions
   query["build-id"] = build_id
   url += service + "/"
 
-if sys.version_info >= (3, 0):
-  upload_content=  bytes(upload_content, "utf8")
-
 if args.check_run and not args.name and 'run-name' in query:
   del query['run-name']
 
 
-request = Request(url + "?" + urlencode(query), upload_content , headers)
-if args.token:   request.add_header("Authorization",  "Bearer " + args.token)
-if content_type: request.add_header("Content-Type", content_type)
+def make_request(shard, compressed, check_run):
+  shard_query = dict(query)
+  if check_run:
+    shard_query['check-run-id'] = check_run
+    if not args.name:
+      shard_query.pop('run-name', None)
 
-if args.check_run:
-  request.get_method = lambda: 'PATCH'
+  request = Request(url + "?" + urlencode(shard_query), upload_content(shard, compressed), headers)
+  if args.token:   request.add_header("Authorization",  "Bearer " + args.token)
+  if content_type: request.add_header("Content-Type", content_type)
+  if compressed:   request.add_header("Content-Encoding", "gzip")
 
-if len(upload_content) > 10000000: # can be done with one upload
-  print(bcolors.FAIL + "Your data is too large (10MB limit) to be done in one upload." + bcolors.ENDC)
-  print(bcolors.OKBLUE + "You can work around that by splitting up your test data using the --include=* argument over several invocations." + bcolors.ENDC)
-  exit(1)
+  if check_run:
+    request.get_method = lambda: 'PATCH'
+  return request
 
+# servers that don't take gzip get the plain body
+def send(shard, check_run):
+  if args.no_compression:
+    return urlopen(make_request(shard, False, check_run))
+  try:
+    return urlopen(make_request(shard, True, check_run))
+  except HTTPError as e:
+    if e.code not in [400, 415]:
+      raise
+    print(bcolors.WARNING + "The compressed upload was rejected (" + str(e.code) + "), sending it uncompressed." + bcolors.ENDC)
+    return urlopen(make_request(shard, False, check_run))
+
+## every shard the server acknowledged is recorded until the upload is complete, running a failed step again only sends the rest.
+## A shard is identified by the query, the file list and its reports.
+def shard_digest(shard):
+  entries = [entry_identity(entry) for entry in shard['results'] + shard['logs']]
+  identity = [sorted((name, value) for (name, value) in query.items() if name not in ['check-run-id', 'run-name']),
+              [file for file in file_list if file not in own_files], args.compact_files, shard['meta'], entries]
+  return hashlib.sha1(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+def write_state():
+  try:
+    open(state_file, 'w').write(json.dumps(state))
+  except:
+    print(bcolors.WARNING + "Could not write the upload state " + state_file + bcolors.ENDC)
+
+def acknowledge(digest, check_run, shard):
+  if str(state["check-run"]) != str(check_run):
+    state.update({"check-run": check_run, "shards": [], "reports": {}})
+  state["shards"].append(digest)
+  for entry in shard['results'] + shard['logs']:
+    state["reports"][entry_file(entry)] = entry_digest(entry)
+  write_state()
+
+digests = [shard_digest(shard) for shard in shards]
+pending = [(shard, digest) for (shard, digest) in zip(shards, digests) if digest not in state["shards"]]
+if not pending:
+  print(bcolors.OKGREEN + "All shards were uploaded before, nothing left to do." + bcolors.ENDC)
+  exit(0)
+if len(pending) < len(shards):
+  print(bcolors.OKBLUE + "    Resuming the upload, " + str(len(shards) - len(pending)) + " of " + str(len(shards)) + " shards are done already" + bcolors.ENDC)
+elif len(shards) > 1:
+  print(bcolors.OKBLUE + "    Uploading in " + str(len(shards)) + " shards" + bcolors.ENDC)
 
 try:
-  response = urlopen(request).read().decode()
-  print(bcolors.OKGREEN + "Published: '{0}".format(response) + bcolors.ENDC)
+  (shard, digest) = pending[0]
+  response = send(shard, args.check_run).read().decode()
   res = json.loads(response)
+  check_run = args.check_run or res["github"]
+  acknowledge(digest, check_run, shard)
+  if started_at is not None:
+    res["started-at"] = started_at
+  open(args.id_file, 'w').write(json.dumps(res))
+
+  for (shard, digest) in pending[1:]:
+    send(shard, check_run).read()
+    acknowledge(digest, check_run, shard)
+
+  # only an interrupted upload resumes, a complete one gets sent again. The reports stay for --delta.
+  state["shards"] = []
+  write_state()
+
+  if blob_hashes:
+    record_blobs(set(blob_hashes.values()))
+
+  print(bcolors.OKGREEN + "Published: '{0}".format(response) + bcolors.ENDC)
   ch_id = str(res["id"])
   print ('Uploaded check_run https://report.ci/reports/gh/{}/{}/rep/{}'.format(owner, repo, ch_id))
-  open(args.id_file, 'w').write(response)
   exit(0)
 
 except Exception as e:
@@ -4,6 +4,7 @@ import os
 import sys
 import argparse
 import subprocess
+import time
 import re
 import fnmatch
 import urllib
@@ -118,6 +119,9 @@ if args.text:
 uc =  bytes(upload_content, "utf8") if sys.version_info >= (3, 0) else upload_content
 
 
+## reports older than this are left over from earlier jobs, see report.py --since
+started_at = time.time()
+
 request = Request(url + "?" + urlencode(query), uc)
 request.add_header("Authorization",  "Bearer " + args.token)
 request.add_header("Content-Type",  "text/plain")
@@ -130,7 +134,8 @@ try:
   res = json.loads(response)
   ch_id = str(res["github"])
   print ('Started check_run https://github.com/{}/{}/runs/{}'.format(owner, repo, ch_id))
-  open(args.id_file, 'w').write(response)
+  res["started-at"] = started_at
+  open(args.id_file, 'w').write(json.dumps(res))
   exit(0)
 except Exception  as e:
   print(bcolors.FAIL + 'Starting failed: {0}'.format(e) + bcolors.ENDC);
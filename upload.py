@@ -8,18 +8,20 @@ import re
 import fnmatch
 import urllib
 import json
+import zlib
 
 if sys.version_info >= (3, 0):
   import urllib
 
   from urllib.parse import urlencode
   from urllib.request import Request, urlopen
+  from urllib.error import HTTPError
 
 
 else:
   from urllib import urlencode
   import urllib2
-  from urllib2 import Request, urlopen
+  from urllib2 import Request, urlopen, HTTPError
 
 
 env = os.environ
@@ -36,11 +38,19 @@ class bcolors:
 
 parser = argparse.ArgumentParser()
 
+## directories that never hold reports worth the walk
+prune_default = [".git*", ".hg", ".svn", "node_modules", "bower_components", ".gradle", ".m2", "bazel-out", ".tox", ".venv", "__pycache__"]
 
 parser.add_argument("-i", "--include", nargs='+', help="Files to include, can cointain unix-style wildcard. (default *.xml)", default=["*.xml", "*.json", "*.trx", "*.tap"])
-parser.add_argument("-x", "--exclude", nargs='+', help="Files to exclude, can cointain unix-style wildcard.", default=[])
+parser.add_argument("-x", "--exclude", nargs='+', help="Files to exclude, can cointain unix-style wildcard. Directories matching are not searched.", default=[])
+parser.add_argument("-P", "--prune", nargs='*', help="Directory names not to descend into, can cointain unix-style wildcard. (default " + ' '.join(prune_default) + ")", default=prune_default)
+parser.add_argument("-g", "--discovery", help="How to find the files: walk the root dir or read the git index, i.e. tracked and untracked but not ignored files.", choices=["walk", "git"], default="walk")
+parser.add_argument("--output_dir", nargs='+', help="Only look into these directories when using git discovery.", default=[])
+parser.add_argument("--allow_ignored", nargs='+', help="Ignored directories to search nonetheless when using git discovery, e.g. build output.", default=[])
 parser.add_argument("-l", "--file_list", nargs='+', help="Explicit file list, if given include and exclude are ignored.", default=None)
 
+parser.add_argument("--shard", help="Split xml uploads over 10MB into several, the first one creates the check run and the rest gets patched into it one after another. Only use this when the server keeps what was uploaded before, a PATCH overwrites it otherwise.", action='store_true', default=False)
+parser.add_argument("--no_compression", help="Send the reports uncompressed, instead of trying gzip first.", action='store_true', default=False)
 parser.add_argument("-t", "--token", help="Token to authenticate (not needed for public projects on appveyor, travis and circle-ci")
 parser.add_argument("-n", "--name", help="Custom defined name of the upload when commiting several builds with the same ci system")
 parser.add_argument("-f", "--framework", choices=["boost", "junit", "testng", "xunit", "cmocka", "unity", "criterion", "bandit",
@@ -68,6 +78,12 @@ if not args.check_run:
   except:
     pass
 
+started_at = None
+try:
+  started_at = json.loads(open(args.id_file, "r").read())["started-at"]
+except:
+  pass
+
 ## Alright, now detect the CI - thanks to codecov for the content
 
 root_dir = None
@@ -407,13 +423,58 @@ def match_file(file_abs):
 
   return match
 
+def prune_dir(name, dir_abs):
+  for pr in args.prune:
+    if fnmatch.fnmatch(name, pr):
+      return True
+
+  dir = os.path.relpath(dir_abs)
+  for exc in args.exclude:
+    if fnmatch.fnmatch(dir, exc) or fnmatch.fnmatch(dir_abs, exc):
+      return True
+
+  return False
+
+# walk the tree with scandir, so pruned directories are never entered and d_type spares us the stat calls
+def walk_files(top):
+  if not hasattr(os, 'scandir'):
+    for (path, subfolders, files) in os.walk(top):
+      subfolders[:] = [sub for sub in subfolders if not prune_dir(sub, os.path.join(path, sub))]
+      for file in files:
+        yield os.path.join(path, file)
+    return
+
+  stack = [top]
+  while stack:
+    path = stack.pop()
+    try:
+      entries = list(os.scandir(path))
+    except OSError:
+      continue
+
+    subfolders = []
+    for entry in entries:
+      try:
+        if entry.is_dir(follow_symlinks=False):
+          if not prune_dir(entry.name, entry.path):
+            subfolders.append(entry.path)
+          continue
+        if entry.is_symlink() and entry.is_dir(): # os.walk doesn't follow these either
+          continue
+      except OSError:
+        continue
+      yield entry.path
+
+    subfolders.reverse()
+    stack.extend(subfolders)
+
 boost_test = []
 junit_test = []
 xunit_test = []
 testng_test = []
 criterion_test = []
 complete_content = []
-file_list = []
+file_list = None
 bandit = []
 catch_test = []
 cxxtest = []
@@ -433,15 +494,31 @@ xunitnet = []
 nunit    = []
 doctest  = []
 
-if not args.file_list:
-  for wk in os.walk(root_dir):
-    (path, subfolders, files) = wk
-    if fnmatch.fnmatch(path, "*/.git*"):
-      continue
-    for file in files:
-      abs_file = os.path.join(path, file)
-      file_list.append(abs_file)
-else:
+## paths as the os gives them, bytes that aren't valid in the file system encoding survive as surrogates, like os.walk does
+fs_path = getattr(os, 'fsdecode', lambda path: path)
+
+# read the candidates from the index, which is way cheaper than crawling the tree
+def git_files(top, dirs):
+  pathspecs = [os.path.relpath(os.path.join(top, dir), top) for dir in dirs]
+  try:
+    files   = fs_path(subprocess.check_output(["git", "-C", top, "ls-files", "-z", "--cached", "--others", "--exclude-standard", "--"] + pathspecs))
+    deleted = fs_path(subprocess.check_output(["git", "-C", top, "ls-files", "-z", "--deleted", "--"] + pathspecs))
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+  # tracked files can still be in pruned directories, e.g. a vendored tree
+  pruned = {'': False}
+  def in_pruned(dir):
+    if dir not in pruned:
+      (parent, name) = os.path.split(dir)
+      pruned[dir] = in_pruned(parent) or prune_dir(name, os.path.join(top, dir))
+    return pruned[dir]
+
+  deleted = set(deleted.split('\0'))
+  return [os.path.join(top, file) for file in files.split('\0') if file and file not in deleted and not in_pruned(os.path.dirname(file))]
+
+if args.file_list:
+  file_list = []
   for file in args.file_list:
     abs = os.path.abspath(file)
     if not os.path.isfile(abs):
@@ -450,6 +527,21 @@ else:
     else:
       file_list.append(abs)
 
+elif args.discovery == "git":
+  file_list = git_files(root_dir, args.output_dir)
+  if file_list is None:
+    print(bcolors.WARNING + "Could not read the git index, searching the whole root dir." + bcolors.ENDC)
+  else:
+    known = set(file_list)
+    for dir in args.allow_ignored:
+      for abs_file in walk_files(os.path.join(root_dir, dir)):
+        if abs_file not in known:
+          known.add(abs_file)
+          file_list.append(abs_file)
+
+if file_list is None:
+  file_list = list(walk_files(root_dir))
+
 
 for abs_file in file_list:
   if match_file(abs_file):
@@ -672,37 +764,43 @@ else:
   framework = args.framework
   print(bcolors.HEADER + framework + " selected" + bcolors.ENDC)
 
+## the xml reports get wrapped into one <root>, so they can be split up along the files if need be
+xml_upload = {}
+def xml_root(parts, tail=""):
+  xml_upload.update(parts=parts, tail=tail)
+  return "<root>" + "".join(parts) + tail + "</root>"
+
 if (framework == "testng"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(testng_test) + "</root>"
+  upload_content = xml_root(testng_test)
   if not run_name: run_name = "TestNG";
 elif (framework == "junit"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test)  + "".join(junit_test) + "".join(["\n    <file>{0}</file>".format(file) for file in file_list]) + "</root>";
+  upload_content = xml_root(xunit_test + junit_test, "".join(["\n    <file>{0}</file>".format(file) for file in file_list]))
   if not run_name: run_name = "JUnit"
 elif framework == "bandit":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(bandit) + "</root>"
+  upload_content = xml_root(bandit)
   if not run_name: run_name = "Bandit"
 elif (framework == "xunit"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test)  + "".join(junit_test) + "".join(["\n    <file>{0}</file>".format(file) for file in file_list]) + "</root>";
+  upload_content = xml_root(xunit_test + junit_test, "".join(["\n    <file>{0}</file>".format(file) for file in file_list]))
   if not run_name: run_name = "xUnit"
 elif (framework == "boost"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(boost_test)  + "</root>"
+  upload_content = xml_root(boost_test)
   if not run_name: run_name = "boost.test"
 elif (framework == "cmocka"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "CMocka"
 elif (framework == "criterion"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(criterion_test) + "</root>"
+  upload_content = xml_root(criterion_test)
   if not run_name: run_name = "Criterion"
 elif (framework == "catch"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(catch_test) + "</root>"
+  upload_content = xml_root(catch_test)
   if not run_name: run_name = "Catch"
 elif (framework == "unity"):
   content_type = "text/plain"
@@ -710,35 +808,35 @@ elif (framework == "unity"):
   if not run_name: run_name = "Unity"
 elif (framework == "cpputest"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "CppUTest"
 elif (framework == "minitest"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "Minitest"
 elif (framework == "cute"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "Cute"
 elif (framework == "doctest"):
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(doctest) + "</root>"
+  upload_content = xml_root(doctest)
   if not run_name: run_name = "Doctest"
 elif framework == "cxxtest":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(cxxtest) + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(cxxtest + xunit_test)
   if not run_name: run_name = "CxxTest"
 elif framework == "gtest":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "GoogleTest"
 elif framework == "qtest":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(qtest) + "</root>"
+  upload_content = xml_root(qtest)
   if not run_name: run_name = "QTest"
 elif framework == "testunit":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(testunit) + "</root>"
+  upload_content = xml_root(testunit)
   if not run_name: run_name = "TestUnit"
 elif framework == "rspec":
   content_type = "application/json"
@@ -750,23 +848,23 @@ elif framework == "mocha":
   if not run_name: run_name = "Mocha"
 elif framework == "xunitnet":
   content_type = "text/xml"
-  upload_content =  "<root>" + "".join(xunitnet) + "</root>"
+  upload_content = xml_root(xunitnet)
   if not run_name: run_name = "XUnit.Net"
 elif framework == "nunit":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(nunit) + "</root>"
+  upload_content = xml_root(nunit)
   if not run_name: run_name = "NUnit"
 elif framework == "phpunit":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "PHPUnit"
 elif framework == "pytest":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "PyTest"
 elif framework == "pyunit":
   content_type = "text/xml"
-  upload_content = "<root>" + "".join(xunit_test) + "</root>"
+  upload_content = xml_root(xunit_test)
   if not run_name: run_name = "PyUnit"
 elif (framework == "ava"):
   content_type = "text/plain"
@@ -810,6 +908,25 @@ if len(upload_content) == 0:
   print(bcolors.FAIL + " No test data to upload.")
   exit(1)
 
+## one upload takes up to 10MB, with --shard the xml reports above that get split up.
+## The first shard creates the check run, the others are patched into it in order.
+upload_limit = 10000000
+
+def utf8_size(value):
+  return len(value.encode('utf-8')) if sys.version_info >= (3, 0) else len(value)
+
+shards = [upload_content]
+if args.shard and utf8_size(upload_content) > upload_limit and xml_upload:
+  overhead = utf8_size("<root>" + xml_upload['tail'] + "</root>")
+  (parts, size) = ([[]], overhead)
+  for part in xml_upload['parts']:
+    part_size = utf8_size(part)
+    if size + part_size > upload_limit and parts[-1]:
+      (parts, size) = (parts + [[]], overhead)
+    parts[-1].append(part)
+    size += part_size
+  shards = ["<root>" + "".join(part) + xml_upload['tail'] + "</root>" for part in parts]
+
 if service and not args.name and run_name:
   if os_name:
     run_name += " [" + service +  ", " + os_name + "]"
@@ -847,25 +964,62 @@ if service and service in ["travis-ci" , "appveyor" , "circle-ci", "github-actio
   url += service + "/"
 
 if sys.version_info >= (3, 0):
-  upload_content=  bytes(upload_content, "utf8")
+  shards = [bytes(shard, "utf8") for shard in shards]
 
 if args.check_run and not args.name and 'run-name' in query:
   del query['run-name']
 
-request = Request(url + "?" + urlencode(query), upload_content , headers)
-if args.token:   request.add_header("Authorization",  "Bearer " + args.token)
-if content_type: request.add_header("Content-Type", content_type)
+## the reports are very repetitive, gzip gets them down a lot
+def gzip_content(content):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+  return compressor.compress(content) + compressor.flush()
+
+def make_request(content, compressed, check_run):
+  shard_query = dict(query)
+  if check_run:
+    shard_query['check-run-id'] = check_run
+    if not args.name:
+      shard_query.pop('run-name', None)
+
+  request = Request(url + "?" + urlencode(shard_query), gzip_content(content) if compressed else content, headers)
+  if args.token:   request.add_header("Authorization",  "Bearer " + args.token)
+  if content_type: request.add_header("Content-Type", content_type)
+  if compressed:   request.add_header("Content-Encoding", "gzip")
+
+  if check_run:
+    request.get_method = lambda: 'PATCH'
+  return request
+
+# servers that don't take gzip get the plain body
+def send(content, check_run):
+  if args.no_compression:
+    return urlopen(make_request(content, False, check_run))
+  try:
+    return urlopen(make_request(content, True, check_run))
+  except HTTPError as e:
+    if e.code not in [400, 415]:
+      raise
+    print(bcolors.WARNING + "The compressed upload was rejected (" + str(e.code) + "), sending it uncompressed." + bcolors.ENDC)
+    return urlopen(make_request(content, False, check_run))
 
-if args.check_run:
-  request.get_method = lambda: 'PATCH'
+if len(shards) > 1:
+  print(bcolors.OKBLUE + "    Uploading in " + str(len(shards)) + " shards" + bcolors.ENDC)
 
 try:
-  response = urlopen(request).read().decode()
-  print(bcolors.OKGREEN + "Published: '{0}".format(response) + bcolors.ENDC)
+  response = send(shards[0], args.check_run).read().decode()
   res = json.loads(response)
+  if started_at is not None:
+    res["started-at"] = started_at
+  open(args.id_file, 'w').write(json.dumps(res))
+
+  if len(shards) > 1:
+    check_run = args.check_run or res["github"]
+    for shard in shards[1:]:
+      send(shard, check_run).read()
+
+  print(bcolors.OKGREEN + "Published: '{0}".format(response) + bcolors.ENDC)
   ch_id = str(res["id"])
   print ('Uploaded check_run https://report.ci/reports/gh/{}/{}/rep/{}'.format(owner, repo, ch_id))
-  open(args.id_file, 'w').write(response)
   exit(0)
 
 except Exception as e: